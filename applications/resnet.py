@@ -1,8 +1,40 @@
-#!/usr/bin/env python3.7
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # In training mode, BatchNorm layers that do not track running statistics still
+    # normalize with the batch statistics but leave the running estimates (and the
+    # batch counter) untouched, whatever their momentum
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    tracking = [bn.track_running_stats for bn in bns]
+    for bn in bns:
+        bn.track_running_stats = False
+    try:
+        yield
+    finally:
+        for bn, track in zip(bns, tracking):
+            bn.track_running_stats = track
+
+
+class Normalize(nn.Module):
+    def __init__(self, mean, std):
+        super(Normalize, self).__init__()
+        mean = torch.tensor(mean, dtype=torch.float)
+        std = torch.tensor(std, dtype=torch.float)
+
+        # Fixed depthwise 1x1 convolution computing (x - mean)/std
+        self.register_buffer('weight', (1/std).reshape(-1, 1, 1, 1))
+        self.register_buffer('bias', -mean/std)
+
+    def forward(self, x):
+        return F.conv2d(x, self.weight, self.bias, groups=self.weight.size(0))
 
 
 class BasicBlock(nn.Module):
@@ -65,9 +97,15 @@ class Bottleneck(nn.Module):
 
 
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, mean=None, std=None,
+                 use_checkpoint=False):
         super(ResNet, self).__init__()
         self.in_planes = 16
+        self.use_checkpoint = use_checkpoint
+
+        self.normalize = nn.Identity()
+        if mean is not None and std is not None:
+            self.normalize = Normalize(mean, std)
 
         self.conv1 = nn.Conv2d(3, 16, kernel_size=3,
                                stride=1, padding=1, bias=False)
@@ -86,17 +124,36 @@ class ResNet(nn.Module):
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
+    def _forward_layer(self, layer, x):
+        # Recompute block activations during backward (training only)
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            for block in layer:
+                if torch.compiler.is_compiling():
+                    # The compiled backward recomputes activations without
+                    # replaying the BatchNorm running statistics updates
+                    x = checkpoint(block, x, use_reentrant=False)
+                else:
+                    # The eager recomputation runs the block again in train mode,
+                    # so freeze the BatchNorm running statistics while it does
+                    x = checkpoint(block, x, use_reentrant=False,
+                                   context_fn=lambda block=block: (contextlib.nullcontext(),
+                                                                   _frozen_bn_stats(block)))
+            return x
+        else:
+            return layer(x)
+
     def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = self.layer4(out)
+        out = self.normalize(x)
+        out = F.relu(self.bn1(self.conv1(out)))
+        out = self._forward_layer(self.layer1, out)
+        out = self._forward_layer(self.layer2, out)
+        out = self._forward_layer(self.layer3, out)
+        out = self._forward_layer(self.layer4, out)
         out = F.avg_pool2d(out, 4)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
 
 
-def ResNet18():
-    return ResNet(BasicBlock, [2, 2, 2, 2])
+def ResNet18(**kwargs):
+    return ResNet(BasicBlock, [2, 2, 2, 2], **kwargs)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.7
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """Robustness application
 
@@ -6,10 +6,7 @@ CIFAR-10 with epsilon-adversarial loss constraint
 
 """
 
-import foolbox
-
 import torch
-import torchvision
 import torch.nn.functional as F
 
 from resnet import ResNet18
@@ -22,26 +19,63 @@ import sys, os
 sys.path.append(os.path.abspath('../'))
 
 import csl, csl.datasets
+from csl.utils import _batches
 
 # Perturbation magnitude
 eps = 0.02
 
+# Training batch size
+batch_size = 256
+
+# Number of replays of each mini-batch ("free" adversarial training)
+replays = 5
+
 # Use GPU if available
 theDevice = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
+# Input shapes are fixed: let cuDNN pick the fastest kernels and use TF32
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
 
 ####################################
 # FUNCTIONS                        #
 ####################################
 def accuracy(yhat, y):
-    _, predicted = torch.max(yhat, 1)
-    correct = (predicted == y).sum().item()
-    return correct/yhat.shape[0]
+    # Number of correct predictions (kept on device to avoid syncing)
+    return (yhat.argmax(1) == y).sum()
+
+def to_device(dataset, subset, transform):
+    # Copy of a subset of the dataset resident on the device as uint8 images
+    resident = copy.copy(dataset)
+    resident.data = dataset.data[subset].mul(255).round_().to(device=theDevice, dtype=torch.uint8,
+                                                              memory_format=torch.channels_last)
+    resident.target = dataset.target[subset].to(theDevice)
+    resident.transform = transform
+    return resident
+
+def to_float(img):
+    return img.float().div_(255)
+
+def augment(img):
+    # Work on an NHWC view so the output keeps the channels-last layout
+    img = img.permute(0, 2, 3, 1)
+
+    # Random horizontal flip
+    n = img.shape[0]
+    flipped = torch.rand(n, device=img.device) < 0.5
+    img = torch.where(flipped[:, None, None, None], img.flip(2), img)
 
-def preprocess(img):
-    mean = torch.tensor([0.4914, 0.4822, 0.4465], dtype = img.dtype, device=theDevice).reshape((3, 1, 1))
-    std = torch.tensor([0.2023, 0.1994, 0.2010], dtype = img.dtype, device=theDevice).reshape((3, 1, 1))
-    return (img - mean) / std
+    # Pad by 4 pixels and randomly crop back to 32 x 32
+    padded = F.pad(img, (0, 0, 4, 4, 4, 4))
+    rows = torch.randint(0, 9, (n, 1), device=img.device) + torch.arange(32, device=img.device)
+    columns = torch.randint(0, 9, (n, 1), device=img.device) + torch.arange(32, device=img.device)
+    img = padded[torch.arange(n, device=img.device)[:, None, None],
+                 rows[:, :, None], columns[:, None, :]]
+
+    return to_float(img.permute(0, 3, 1, 2))
 
 
 ####################################
@@ -50,28 +84,22 @@ def preprocess(img):
 n_train = 4900
 n_valid = 100
 
-target = csl.datasets.CIFAR10(root = 'data', train = True)[:][1]
+# Load the training set only once and split it on the device
+cifar10 = csl.datasets.CIFAR10(root = 'data', train = True)
+target = cifar10.target
 
 label_idx = [np.flatnonzero(target == label) for label in range(0,10)]
 label_idx = [np.random.RandomState(seed=42).permutation(idx) for idx in label_idx]
 train_subset = [idx[:n_train] for idx in label_idx]
 train_subset = np.array(train_subset).flatten()
 
-train_transform = torchvision.transforms.Compose([
-    csl.datasets.utils.RandomFlip(),
-    csl.datasets.utils.RandomCrop(size=32,padding=4),
-    csl.datasets.utils.ToTensor(device=theDevice)
-    ])
-
-trainset = csl.datasets.CIFAR10(root = 'data', train = True, subset = train_subset,
-                                transform = train_transform,
-                                target_transform = csl.datasets.utils.ToTensor(device=theDevice))
+trainset = to_device(cifar10, train_subset, transform = augment)
 
 valid_subset = [idx[n_train:n_train+n_valid] for idx in label_idx]
 valid_subset = np.array(valid_subset).flatten()
-validset = csl.datasets.CIFAR10(root = 'data', train = True, subset = valid_subset,
-                                transform = csl.datasets.utils.ToTensor(device=theDevice),
-                                target_transform = csl.datasets.utils.ToTensor(device=theDevice))
+validset = to_device(cifar10, valid_subset, transform = to_float)
+
+del cifar10
 
 
 ####################################
@@ -79,9 +107,12 @@ validset = csl.datasets.CIFAR10(root = 'data', train = True, subset = valid_subs
 ####################################
 class robustLoss(csl.ConstrainedLearningProblem):
     def __init__(self, rhs):
-        self.model = csl.PytorchModel(ResNet18().to(theDevice))
+        net = ResNet18(mean = csl.datasets.CIFAR10.MEAN,
+                       std = csl.datasets.CIFAR10.SD,
+                       use_checkpoint = True).to(theDevice, memory_format=torch.channels_last)
+        self.model = csl.PytorchModel(net)
         self.data = trainset
-        self.batch_size = 256
+        self.batch_size = batch_size
 
         self.obj_function = self.obj_fun
 
@@ -89,51 +120,132 @@ class robustLoss(csl.ConstrainedLearningProblem):
         self.constraints = [self.adversarialLoss]
         self.rhs = [rhs]
 
-        self.foolbox_model = foolbox.PyTorchModel(self.model.model, bounds=(0, 1),
-                                                  device=theDevice,
-                                                  preprocessing = dict(mean=[0.4914, 0.4822, 0.4465],
-                                                                       std=[0.2023, 0.1994, 0.2010],
-                                                                       axis=-3))
-        self.attack = foolbox.attacks.LinfPGD(rel_stepsize = 1/3, abs_stepsize = None,
-                                              steps = 5, random_start = True)
+        # Compiled mixed-precision forward pass
+        def forward(x):
+            with torch.autocast(device_type = theDevice.type, dtype = torch.bfloat16):
+                yhat = net(x.contiguous(memory_format=torch.channels_last))
+            return yhat.float()
 
-        super().__init__()
+        # CUDA graphs (reduce-overhead) only help on the GPU
+        compile_mode = 'reduce-overhead' if theDevice.type == 'cuda' else 'default'
+        self._fwd = torch.compile(forward, mode = compile_mode)
 
-    def obj_fun(self, batch_idx):
-        x, y = self.data[batch_idx]
+        # PGD buffers reused across batches (smaller tail batches use a slice)
+        self._pgd_delta = torch.empty((batch_size, 3, 32, 32), device=theDevice)
+        self._pgd_x_adv = torch.empty_like(self._pgd_delta)
 
-        yhat = self.model(preprocess(x))
+        # Free adversarial training perturbation: seeded at the start of each
+        # mini-batch (see adversarialLoss) and updated across its replays
+        self._free_delta = torch.zeros((batch_size, 3, 32, 32), device=theDevice, requires_grad=True)
 
-        return 0.1*self._loss(yhat, y)
+        # Current mini-batch
+        self._batch_idx = None
+        self._new_batch = False
 
-    def adversarialLoss(self, batch_idx, primal):
-        x, y = self.data[batch_idx]
+        super().__init__()
 
-        # Attack
-        self.model.eval()
+    def obj_fun(self, batch_idx):
+        x, y = self._batch(batch_idx)
 
-        # Save gradients before adversarial runs
-        saved_grad = [copy.deepcopy(p.grad) for p in self.model.parameters]
+        # On a new batch, the objective's backward pass also yields the input gradient
+        # at the clean point, which is used to start the perturbation (see adversarialLoss)
+        x.grad = None
+        x.requires_grad_(torch.is_grad_enabled() and self._new_batch)
 
-        # Dual is computed in a no_grad() environment
-        x_processed, _, _ = self.attack(self.foolbox_model, x, y, epsilons = eps)
+        yhat = self._fwd(x)
 
-        # Reload gradients
-        for p,g in zip(self.model.parameters, saved_grad):
-            p.grad = g
+        return 0.1*self._loss(yhat, y)
 
-        if primal:
-            self.model.train()
-            yhat = self.model(preprocess(x_processed))
+    def adversarialLoss(self, batch_idx, primal):
+        x, y = self._batch(batch_idx)
+        x_grad, x = x.grad, x.detach()
+
+        # The perturbation state is only used (and updated) by primal updates. When
+        # gradients are disabled (e.g., full-pass evaluations), attack from scratch
+        if primal and torch.is_grad_enabled():
+            if self._new_batch and x_grad is not None:
+                # Start from the signed gradient at the clean point, obtained
+                # from the objective's backward pass
+                self._free_delta.data[:x.shape[0]] = eps*x_grad.sign()
+            elif self._free_delta.grad is not None:
+                # The backward pass of the previous primal update also computed the
+                # gradient w.r.t. the perturbation, so take the ascent step from it
+                self._free_delta.data.add_(eps*self._free_delta.grad.sign()).clamp_(-eps, eps)
+            self._free_delta.grad = None
+            self._new_batch = False
+
+            # The Lagrangian backward pass scales the gradient w.r.t. the perturbation
+            # by the dual variable, so it vanishes while the constraint is inactive.
+            # In that case, take it from a separate attack-style (eval mode) pass on the
+            # unscaled loss. The compiled backward cannot retain its graph, so this pass
+            # cannot share the forward used by the Lagrangian.
+            if self.lambdas[0] == 0:
+                n = x.shape[0]
+                delta = self._free_delta[:n].detach().requires_grad_(True)
+                self.model.eval()
+                loss = self._loss(self._fwd((x + delta).clamp(0, 1)), y)
+                g = torch.autograd.grad(loss, delta, only_inputs = True, retain_graph = False)[0]
+                self.model.train()
+                self._free_delta.grad = torch.zeros_like(self._free_delta)
+                self._free_delta.grad[:n] = g
+
+            yhat = self._fwd((x + self._free_delta[:x.shape[0]]).clamp(0, 1))
             loss = self._loss(yhat, y)
         else:
-            with torch.no_grad():
-                yhat = self.model(preprocess(x_processed))
+            self.model.eval()
+            x_processed = self._pgd_linf(x, y, eps = eps, steps = 5, alpha = eps/3)
+            with torch.inference_mode():
+                yhat = self._fwd(x_processed)
                 loss = self._loss(yhat, y)
             self.model.train()
 
         return loss
 
+    def _batch(self, batch_idx):
+        # The mini-batch is gathered (and augmented) on the device only once and
+        # shared by the objective, the constraints, and the replays
+        if batch_idx is not self._batch_idx:
+            self._batch_idx = batch_idx
+            self._new_batch = True
+            self._x, self._y = self.data[torch.as_tensor(batch_idx, device=theDevice)]
+
+        return self._x, self._y
+
+    def _pgd_linf(self, x, y, eps, steps, alpha):
+        # Gradients are taken only w.r.t. the perturbation, so the
+        # parameters' .grad are left untouched
+        n = x.shape[0]
+        delta = self._pgd_delta[:n].uniform_(-eps, eps).detach().requires_grad_(True)
+
+        with torch.enable_grad():
+            for _ in range(steps):
+                yhat = self._fwd((x + delta).clamp(0, 1))
+                loss = self._loss(yhat, y)
+                g = torch.autograd.grad(loss, delta, only_inputs = True, retain_graph = False)[0]
+                delta.data.add_(alpha*g.sign()).clamp_(-eps, eps)
+
+        # The returned adversarial is overwritten by the next call
+        return torch.add(x, delta.detach(), out=self._pgd_x_adv[:n]).clamp_(0, 1)
+
+    def _pgd_linf_multi(self, x, y, epsilons, steps, rel_stepsize):
+        # All perturbation magnitudes are attacked at once as a single
+        # (len(epsilons) x N) batch sharing each forward/backward pass
+        eps = torch.as_tensor(epsilons, dtype=x.dtype, device=x.device).reshape(-1, 1, 1, 1, 1)
+        alpha = rel_stepsize*eps
+        y_all = y.repeat(eps.shape[0])
+
+        delta = (2*torch.rand((eps.shape[0],) + x.shape, device=x.device) - 1)*eps
+        delta.requires_grad_(True)
+
+        with torch.enable_grad():
+            for _ in range(steps):
+                yhat = self._fwd((x + delta).clamp(0, 1).flatten(0, 1))
+                loss = F.cross_entropy(yhat, y_all, reduction = 'sum')
+                g = torch.autograd.grad(loss, delta, only_inputs = True, retain_graph = False)[0]
+                delta.data = torch.max(torch.min(delta.data + alpha*g.sign(), eps), -eps)
+
+        return (x + delta).clamp(0, 1).detach()
+
     @staticmethod
     def _loss(yhat, y):
         return F.cross_entropy(yhat, y)
@@ -145,28 +257,27 @@ def validation_hook(problem, solver_state):
         adv_epoch = 10
         _adv_epoch = adv_epoch
 
-        batch_idx = np.arange(0, len(validset)+1, problem.batch_size)
-        if batch_idx[-1] < len(validset):
-            batch_idx = np.append(batch_idx, len(validset))
-
         # Validate
-        acc = 0
-        acc_adv = 0
+        acc = torch.zeros((), dtype=torch.long, device=theDevice)
+        acc_adv = torch.zeros_like(acc)
         problem.model.eval()
-        for batch_start, batch_end in zip(batch_idx, batch_idx[1:]):
+        for batch_start, batch_end in _batches(len(validset), problem.batch_size):
             x, y = validset[batch_start:batch_end]
-            with torch.no_grad():
-                yhat = problem.model(preprocess(x))
-                acc += accuracy(yhat, y)*(batch_end - batch_start)/len(validset)
+            with torch.inference_mode():
+                yhat = problem._fwd(x)
+                acc += accuracy(yhat, y)
 
             # Attack
             if _adv_epoch == 1:
-                adversarial, _, _ = problem.attack(problem.foolbox_model, x, y, epsilons = eps)
-                with torch.no_grad():
-                    yhat_adv = problem.model(preprocess(adversarial))
-                    acc_adv += accuracy(yhat_adv, y)*(batch_end - batch_start)/len(validset)
+                adversarial = problem._pgd_linf(x, y, eps = eps, steps = 5, alpha = eps/3)
+                with torch.inference_mode():
+                    yhat_adv = problem._fwd(adversarial)
+                    acc_adv += accuracy(yhat_adv, y)
         problem.model.train()
 
+        acc = acc.item()/len(validset)
+        acc_adv = acc_adv.item()/len(validset)
+
         # Results
         if _adv_epoch > 1:
             print(f"Validation accuracy: {acc*100:.2f} / Dual variables: {[lambda_value.item() for lambda_value in problem.lambdas]}")
@@ -179,9 +290,10 @@ def validation_hook(problem, solver_state):
 
 problem = robustLoss(rhs=0.7)
 
-solver_settings = {'iterations': 400,
+solver_settings = {'iterations': 400//replays,
                    'verbose': 1,
-                   'batch_size': 128,
+                   'batch_size': batch_size,
+                   'replays': replays,
                    'primal_solver': lambda p: torch.optim.Adam(p, lr=0.01),
                    'lr_p_scheduler': None,
                    'dual_solver': lambda p: torch.optim.Adam(p, lr=0.001),
@@ -199,50 +311,39 @@ solver.plot()
 # TESTING                          #
 ####################################
 # Test data
-testset = csl.datasets.CIFAR10(root = 'data', train = False,
-                               transform = csl.datasets.utils.ToTensor(device=theDevice),
-                               target_transform = csl.datasets.utils.ToTensor(device=theDevice))
+testset = csl.datasets.CIFAR10(root = 'data', train = False)
+testset = to_device(testset, slice(None), transform = to_float)
 
 # Adversarial attack
 problem.model.eval()
-foolbox_model = foolbox.PyTorchModel(problem.model.model, bounds=(0, 1),
-                                     device=theDevice,
-                                     preprocessing = dict(mean=[0.4914, 0.4822, 0.4465],
-                                                          std=[0.2023, 0.1994, 0.2010],
-                                                          axis=-3))
-attack = foolbox.attacks.LinfPGD(rel_stepsize = 1/30, abs_stepsize = None,
-                                 steps = 50, random_start = True)
 epsilon_test = np.linspace(0.01,0.06,7)
 
-# Prepare batches
-batch_idx = np.arange(0, len(testset)+1, problem.batch_size)
-if batch_idx[-1] < len(testset):
-    batch_idx = np.append(batch_idx, len(testset))
-
 n_total = 0
-acc_test = 0
-acc_adv = np.zeros(epsilon_test.shape[0])
-success_adv = np.zeros_like(acc_adv)
+acc_test = torch.zeros((), dtype=torch.long, device=theDevice)
+acc_adv = torch.zeros(epsilon_test.shape[0], dtype=torch.long, device=theDevice)
+success_adv = torch.zeros_like(acc_adv)
 
-for batch_start, batch_end in zip(batch_idx, batch_idx[1:]):
+for batch_start, batch_end in _batches(len(testset), problem.batch_size):
     x_test, y_test = testset[batch_start:batch_end]
 
     # Nominal accuracy
-    yhat = problem.model(preprocess(x_test))
-    acc_test += accuracy(yhat, y_test)*(batch_end - batch_start)
+    with torch.inference_mode():
+        yhat = problem._fwd(x_test)
+        acc_test += accuracy(yhat, y_test)
 
     # Adversarials accuracy
-    adversarials, _, success = attack(foolbox_model, x_test, y_test, epsilons = epsilon_test)
-    for ii, adv in enumerate(adversarials):
-        yhat_adv = problem.model(preprocess(adv))
-        acc_adv[ii] += accuracy(yhat_adv, y_test)*(batch_end - batch_start)
-        success_adv[ii] += torch.sum(success[ii])
+    adversarials = problem._pgd_linf_multi(x_test, y_test, epsilon_test, steps = 50, rel_stepsize = 1/30)
+    with torch.inference_mode():
+        yhat_adv = problem._fwd(adversarials.flatten(0, 1)).reshape(adversarials.shape[:2] + (-1,))
+        correct = (yhat_adv.argmax(-1) == y_test).sum(dim=1)
+        acc_adv += correct
+        success_adv += (batch_end - batch_start) - correct
 
     n_total += batch_end - batch_start
 
-acc_test /= n_total
-acc_adv /= n_total
-success_adv /= n_total
+acc_test = acc_test.item()/n_total
+acc_adv = acc_adv.cpu().numpy()/n_total
+success_adv = success_adv.cpu().numpy()/n_total
 
 print('====== TEST ======')
 print(f'Test accuracy: {100*acc_test:.2f}')
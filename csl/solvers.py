@@ -125,11 +125,14 @@ class SimultaneousPrimalDual(PrimalDualBase):
 
             - ``batch_size``: Mini-batch size. The default is `None` (uses full dataset at once).
             - ``shuffle``: Shuffle dataset before batching. The default is `True`.
+            - ``replays``: Number of consecutive primal-dual updates on each mini-batch
+              (as in "free" adversarial training). The default is 1.
 
         """
         settings = SolverSettings({
             'batch_size': None,
-            'shuffle': True
+            'shuffle': True,
+            'replays': 1
         })
 
         settings.initialize(user_settings)
@@ -163,45 +166,50 @@ class SimultaneousPrimalDual(PrimalDualBase):
         ### START OF EPOCH ###
         for batch_start, batch_end in _batches(problem.data_size, self.settings['batch_size']):
             batch_idx = idx_epoch[batch_start:batch_end]
-
-            ### PRIMAL UPDATE ###
-            # Gradient step
-            self.primal_solver.zero_grad()
-            _, obj_value, constraint_slacks, pointwise_slacks = problem.lagrangian(batch_idx)
-            self.primal_solver.step()
-
-            # Compute primal quantities estimates
-            with torch.no_grad():
-                primal_value_est += obj_value*(batch_end - batch_start)/problem.data_size
-                primal_grad_norm_est += np.sum([p.grad.norm().item()**2 for p in problem.model.parameters])*(batch_end - batch_start)/problem.data_size
-
-            ### DUAL UPDATE ###
-            if self.state_dict['HAS_CONSTRAINTS']:
-                # Set gradients
-                for ii, slack in enumerate(constraint_slacks):
-                    problem.lambdas[ii].grad = -slack
-                    constraint_slacks_est[ii] += slack*(batch_end - batch_start)/problem.data_size
-
-                    if problem.lambdas[ii] > 0 or (problem.lambdas[ii] == 0 and slack > 0):
-                        dual_grad_norm_est += slack**2*(batch_end - batch_start)/problem.data_size
-
-                for ii, slack in enumerate(pointwise_slacks):
-                    expanded_slack = torch.zeros_like(problem.mus[ii])
-                    expanded_slack[batch_idx] = slack
-                    problem.mus[ii].grad = -expanded_slack
-                    pointwise_slacks_est[ii][batch_idx] = slack
-
-                    inactive = torch.logical_or(problem.mus[ii][batch_idx] > 0, \
-                                                torch.logical_and(problem.mus[ii][batch_idx] == 0, slack > 0))
-                    dual_grad_norm_est += torch.norm(slack[inactive]).item()**2
-
-                # Gradient gradient step
-                self.dual_solver.step()
-
-                # Project onto non-negative orthant
-                for ii, _ in enumerate(problem.lambdas):
-                    problem.lambdas[ii][problem.lambdas[ii] < 0] = 0
-                for ii, _ in enumerate(problem.mus):
-                    problem.mus[ii][problem.mus[ii] < 0] = 0
+            batch_weight = (batch_end - batch_start)/problem.data_size/self.settings['replays']
+
+            for _ in range(self.settings['replays']):
+                ### PRIMAL UPDATE ###
+                # Gradient step
+                self.primal_solver.zero_grad()
+                _, obj_value, constraint_slacks, pointwise_slacks = problem.lagrangian(batch_idx)
+                self.primal_solver.step()
+
+                # Compute primal quantities estimates
+                with torch.no_grad():
+                    primal_value_est += obj_value*batch_weight
+                    primal_grad_norm_est += np.sum([p.grad.norm().item()**2 for p in problem.model.parameters])*batch_weight
+
+                ### DUAL UPDATE ###
+                if self.state_dict['HAS_CONSTRAINTS']:
+                    # Set gradients
+                    # Slacks from the primal update still carry its autograd graph
+                    for ii, slack in enumerate(constraint_slacks):
+                        slack = slack.detach()
+                        problem.lambdas[ii].grad = -slack
+                        constraint_slacks_est[ii] += slack*batch_weight
+
+                        if problem.lambdas[ii] > 0 or (problem.lambdas[ii] == 0 and slack > 0):
+                            dual_grad_norm_est += slack**2*batch_weight
+
+                    for ii, slack in enumerate(pointwise_slacks):
+                        slack = slack.detach()
+                        expanded_slack = torch.zeros_like(problem.mus[ii])
+                        expanded_slack[batch_idx] = slack
+                        problem.mus[ii].grad = -expanded_slack
+                        pointwise_slacks_est[ii][batch_idx] = slack
+
+                        inactive = torch.logical_or(problem.mus[ii][batch_idx] > 0, \
+                                                    torch.logical_and(problem.mus[ii][batch_idx] == 0, slack > 0))
+                        dual_grad_norm_est += torch.norm(slack[inactive]).item()**2/self.settings['replays']
+
+                    # Gradient gradient step
+                    self.dual_solver.step()
+
+                    # Project onto non-negative orthant
+                    for ii, _ in enumerate(problem.lambdas):
+                        problem.lambdas[ii][problem.lambdas[ii] < 0] = 0
+                    for ii, _ in enumerate(problem.mus):
+                        problem.mus[ii][problem.mus[ii] < 0] = 0
 
         return primal_value_est, primal_grad_norm_est, constraint_slacks_est, pointwise_slacks_est, dual_grad_norm_est